@@ -13,13 +13,16 @@
 # limitations under the License.
 
 # [START gae_python37_app]
-from flask import Flask
+from flask import Flask, Response
 from flask_restful import Resource, Api, request
+import heapq
 import json
+import math
+import numpy as np
 import pandas as pd
 import os
-import geopy.distance
-from fuzzywuzzy import fuzz
+from functools import lru_cache
+from rapidfuzz import fuzz, process, utils
 from operator import itemgetter
 from voluptuous import Required, All, Length, Range, Schema, MultipleInvalid, Invalid, Coerce
 
@@ -29,176 +32,285 @@ app = Flask(__name__)
 api = Api(app)
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 
+# Number of suggestions returned when the caller does not pass `limit`
+DEFAULT_LIMIT = 10
+
+# Shorter queries match too much of the country to be useful
+MIN_QUERY_LENGTH = 2
+
+# Query string validation for /suggestions, built once at import time
+REQUEST_SCHEMA = Schema({
+    Required('q'): All(str, Length(min=1)),
+    'latitude': All(Coerce(float), Range(min=-90.00, max=90.00)),
+    'longitude': All(Coerce(float), Range(min=-180.00, max=180.00)),
+    'limit': All(Coerce(int), Range(min=1))
+})
+
+# Mean radius of the earth, used for great-circle distances
+EARTH_RADIUS_KM = 6371.0
+
+# FIPS code -> two letter province code, for Canadian cities
+FIPS_MAP = {
+    "01": "AB",
+    "02": "BC",
+    "03": "MB",
+    "04": "NB",
+    "05": "NL",
+    "07": "NS",
+    "08": "ON",
+    "09": "PE",
+    "10": "QC",
+    "11": "SK",
+    "12": "YT",
+    "13": "NT",
+    "14": "NU"
+}
+
+
+def load_cities():
+    """
+    Reads the cities file and pre-normalizes the columns used by
+    the suggestions endpoint, so requests only have to score rows.
+
+    `ascii`: lowercased city name
+    `ascii_norm`: city name as rapidfuzz's default processor sees it
+    `suffix`: "<province>, Canada" or "<state>, USA"
+    """
+    # Only parse the columns the endpoint uses; admin1 mixes FIPS codes
+    # like "02" with state codes, so keep it as text
+    df = pd.read_table(os.path.join(APP_ROOT, "data", "cities_canada-usa.tsv"),
+                       usecols=["ascii", "admin1", "lat", "long"],
+                       dtype={"ascii": str, "admin1": str})
+
+    # Cities without an ascii name can never be suggested
+    df = df.dropna(subset=["ascii"]).reset_index(drop=True)
+
+    df["ascii"] = df["ascii"].str.lower()
+    df["ascii_norm"] = [utils.default_process(name) for name in df["ascii"]]
+
+    canada = df["admin1"].str.isdigit()
+    df["suffix"] = (df["admin1"] + ", USA").mask(canada, df["admin1"].map(FIPS_MAP) + ", Canada")
+
+    return df
+
+
+# Loaded once per worker instead of on every request
+CITIES_DF = load_cities()
+
+# Contiguous float32 coordinates in radians for haversine(), indexed
+# by CITIES_DF row
+LATS_RAD = np.radians(CITIES_DF["lat"].to_numpy(np.float32))
+LONGS_RAD = np.radians(CITIES_DF["long"].to_numpy(np.float32))
+
+# Candidate names handed to rapidfuzz, aligned with the rows of CITIES_DF
+CITY_NAMES = CITIES_DF["ascii_norm"].to_numpy(dtype=object)
+
+
+def build_buckets(names):
+    """
+    `names`: Iterable of normalized city names
+
+    Returns a dict mapping a letter to the sorted numpy array of row
+    indices whose name has a word starting with that letter.
+    """
+    buckets = {}
+    for i, name in enumerate(names):
+        for letter in {word[0] for word in name.split()}:
+            buckets.setdefault(letter, []).append(i)
+    return {letter: np.array(rows) for letter, rows in buckets.items()}
+
+
+# First letter of each word -> rows, to narrow down what gets scored
+BUCKETS = build_buckets(CITY_NAMES)
+
+
+@lru_cache(maxsize=256)
+def get_candidates(initials):
+    """
+    `initials`: frozenset of the first letters of the query's words
+
+    Returns the sorted row indices of every city in the matching
+    BUCKETS, along with their names. Successive autocomplete queries
+    ("lo", "lon", "lond", ...) share the same initials, so the merged
+    candidate set is built once and reused across requests.
+    """
+    buckets = [BUCKETS[letter] for letter in initials if letter in BUCKETS]
+    rows = np.unique(np.concatenate(buckets)) if buckets else np.array([], dtype=int)
+    names = CITY_NAMES[rows]
+    rows.flags.writeable = False
+    names.flags.writeable = False
+    return rows, names
+
+
+@lru_cache(maxsize=256)
+def get_fuzzy_scores(q):
+    """
+    The scoring function takes the following argument
+    `q`: String (ascii) - the query string, already passed
+         through rapidfuzz's `utils.default_process`
+
+    The function uses the concept of Fuzzy String Matching to generate
+    a similarity score by comparing q with the name of every city.
+    All names are scored in a single rapidfuzz `cdist` call, and the
+    returned numpy array is aligned with the rows of CITIES_DF.
+
+    Only cities with a word starting like one of the words of q are
+    scored (see BUCKETS); every other city gets a score of 0.
+
+    Autocomplete clients repeat the same queries a lot, so the score
+    arrays are memoized per normalized query. The cached arrays are
+    read-only and must not be modified by callers.
+
+    `token set approach` - example
+
+    we tokenize both strings, but instead of immediately
+    sorting and comparing, we split the tokens into two
+    groups: intersection and remainder. We use those
+    sets to build up a comparison string.
+
+    s1 = "mariners vs angels"
+    s2 = "los angeles angels of anaheim at seattle mariners"
+
+    the set method allows us to detect that “angels” and “mariners”
+    are common to both strings, and separate those out
+    (the set intersection). Now we construct and compare strings
+    of the following form
 
-@app.route('/')
-def hello():
-    """Return a friendly HTTP greeting."""
-    return 'Example: /suggestions?q=Londo&latitude=43.70011&longitude=-79.4163'
+    t0 = [SORTED_INTERSECTION]
+    t1 = [SORTED_INTERSECTION] + [SORTED_REST_OF_STRING1]
+    t2 = [SORTED_INTERSECTION] + [SORTED_REST_OF_STRING2]
 
+    And then compare each pair.
 
-class Suggestions(Resource):
-    def fips_mapping(self, fips_code):
-        """
-        `fips_code`: String
-        
-        Function returns the two letter province code
-        """
-        fips_map = {
-            "01": "AB",
-            "02": "BC",
-            "03": "MB",
-            "04": "NB",
-            "05": "NL",
-            "07": "NS",
-            "08": "ON",
-            "09": "PE",
-            "10": "QC",
-            "11": "SK",
-            "12": "YT",
-            "13": "NT",
-            "14": "NU"
-        }
-        return fips_map[fips_code]
-
-    def isascii(self, s):
-        """
-        The scoring function takes the following argument
-        `q`: Unicode
+    t0 = "angels mariners"
+    t1 = "angels mariners vs"
+    t2 = "angels mariners anaheim angeles at los of seattle"
+    fuzz.ratio(t0, t1) ⇒ 90
+    fuzz.ratio(t0, t2) ⇒ 46
+    fuzz.ratio(t1, t2) ⇒ 50
 
-        Function returns True if string contains only
-        ascii characters and returns False if the string
-        contains non-ascii characters
-        """
-        return len(s) == len(s.encode())
-
-    def get_fuzzy_score(self, q, name):
-        """
-        The scoring function takes the following arguments
-        `q`: String (ascii) - the query string
-        `name`: String (ascii) - the name of the city
+    The intuition here is that because the SORTED_INTERSECTION
+    component is always exactly the same, the scores increase
+    when (a) that makes up a larger percentage of the full string,
+    and (b) the string remainders are more similar.
+    """
+    scores = np.zeros(len(CITY_NAMES))
+
+    candidates, names = get_candidates(frozenset(word[0] for word in q.split()))
+    if len(candidates):
+        # Both sides are already normalized, so no processor is passed
+        candidate_scores = process.cdist([q], names, scorer=fuzz.token_set_ratio,
+                                         score_cutoff=50, dtype=np.float64, workers=-1)[0]
+        # Round to whole percents like fuzzywuzzy did
+        scores[candidates] = np.rint(candidate_scores) / 100
+
+    scores.flags.writeable = False
+    return scores
+
+
+def haversine(latitude, longitude, lats_rad, longs_rad):
+    """
+    `latitude`, `longitude`: Float - the caller's location in degrees
+    `lats_rad`, `longs_rad`: numpy arrays - city coordinates in radians
+
+    Returns a numpy array with the great-circle distance in km from
+    the caller to every city. Accurate enough to rank suggestions and
+    far cheaper than solving the ellipsoid per city.
+
+    The caller's side is kept as plain Python floats so float32 city
+    arrays are not upcast to float64.
+    """
+    lat1, long1 = math.radians(latitude), math.radians(longitude)
+    a = (np.sin((lats_rad - lat1) / 2) ** 2
+         + math.cos(lat1) * np.cos(lats_rad) * np.sin((longs_rad - long1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
 
-        The function uses the concept of Fuzzy String Matching to generate
-        a similarity score by comparing q with the name
 
-        fuzzywuzzy's - `token set approach` - example
-
-        we tokenize both strings, but instead of immediately
-        sorting and comparing, we split the tokens into two
-        groups: intersection and remainder. We use those
-        sets to build up a comparison string.
-
-        s1 = "mariners vs angels"
-        s2 = "los angeles angels of anaheim at seattle mariners"
-
-        the set method allows us to detect that “angels” and “mariners”
-        are common to both strings, and separate those out
-        (the set intersection). Now we construct and compare strings
-        of the following form
-
-        t0 = [SORTED_INTERSECTION]
-        t1 = [SORTED_INTERSECTION] + [SORTED_REST_OF_STRING1]
-        t2 = [SORTED_INTERSECTION] + [SORTED_REST_OF_STRING2]
-
-        And then compare each pair.
+@app.route('/')
+def hello():
+    """Return a friendly HTTP greeting."""
+    return 'Example: /suggestions?q=Londo&latitude=43.70011&longitude=-79.4163'
 
-        t0 = "angels mariners"
-        t1 = "angels mariners vs"
-        t2 = "angels mariners anaheim angeles at los of seattle"
-        fuzz.ratio(t0, t1) ⇒ 90
-        fuzz.ratio(t0, t2) ⇒ 46
-        fuzz.ratio(t1, t2) ⇒ 50
-
-        The intuition here is that because the SORTED_INTERSECTION
-        component is always exactly the same, the scores increase
-        when (a) that makes up a larger percentage of the full string,
-        and (b) the string remainders are more similar.
-        """
-        current_score = fuzz.token_set_ratio(q, name.strip())
-        return current_score/100 if current_score > 0 else 0
 
+class Suggestions(Resource):
     def truncate(self, n, decimals=0):
         """
-        `n`: Float
+        `n`: Float or numpy array
         `decimals`: Int 
 
         Example: truncate(self, 72.8500, decimals=1)
         Convertes 72.8500 to 72.8
         """
         multiplier = 10 ** decimals
-        return int(n * multiplier) / multiplier
+        return np.trunc(n * multiplier) / multiplier
+
+    def stream(self, suggestions):
+        """
+        `suggestions`: List of suggestion dicts, already ranked
+
+        Yields the JSON body `{"suggestions": [...]}` one suggestion
+        at a time, dropping the internal `distance` key on the way.
+        """
+        yield '{"suggestions": ['
+        for i, suggestion in enumerate(suggestions):
+            suggestion.pop("distance", None)
+            yield (", " if i else "") + json.dumps(suggestion)
+        yield ']}'
 
     def get(self):
 
         args = request.args.to_dict()
 
-        schema = Schema({
-            Required('q'): All(str, Length(min=1)),
-            'latitude': All(Coerce(float), Range(min=-90.00, max=90.00)),
-            'longitude': All(Coerce(float), Range(min=-180.00, max=180.00))
-        })
-
         try:
-            schema(args)
+            REQUEST_SCHEMA(args)
         except Invalid as e:
             return str(e)
         except MultipleInvalid as e:
             return str(e)
 
-        response = {
-            "suggestions": []
-        }
-
-        if not args['q'].isdigit() and self.isascii(args['q']):
-
-            df = pd.read_table(os.path.join(APP_ROOT, "data", "cities_canada-usa.tsv"))
-
-            ids = df['id'].tolist()
-
-            q = args["q"]
-
-            for rid in ids:
-                row = df.loc[df['id'] == rid]
-
-                if pd.isna(row["ascii"].values[0]):
-                    continue
-
-                name = row["ascii"].values[0]
-
-                score = self.get_fuzzy_score(q, name)
-
-                if score > 0.5:
-                    if row["admin1"].values[0].isdigit():
-                        # Canada
-                        suffix = self.fips_mapping(row["admin1"].values[0]) + ", Canada"
-                    else:
-                        # USA
-                        suffix = row["admin1"].values[0] + ", USA"
-
-                    if "latitude" in args and "longitude" in args:
-                        response["suggestions"].append({
-                            "name": name.title() + ", " + suffix,
-                            "latitude": row["lat"].values[0],
-                            "longitude": row["long"].values[0],
-                            "score": self.truncate(score, decimals=1),
-                            "distance": geopy.distance.distance((args["latitude"], args["longitude"]), (row["lat"].values[0], row["long"].values[0])).km
-                        })
-                    else:
-                        response["suggestions"].append({
-                            "name": name.title() + ", " + suffix,
-                            "latitude": row["lat"].values[0],
-                            "longitude": row["long"].values[0],
-                            "score": self.truncate(score, decimals=1)
-                        })
-
-            if "latitude" in args and "longitude" in args:
-                response["suggestions"] = sorted(response["suggestions"], key=lambda element: (-element["score"], element["distance"]))
-                [result.pop('distance', None) for result in response["suggestions"]]
-            else:
-                response["suggestions"] = sorted(response["suggestions"], key=itemgetter('score'), reverse=True)
-
-            return response
+        q = args["q"]
+
+        # Nothing to suggest, skip scoring altogether
+        if q.isdigit() or not q.isascii() or len(q) < MIN_QUERY_LENGTH:
+            return Response(self.stream([]), mimetype='application/json')
+
+        limit = int(args.get("limit", DEFAULT_LIMIT))
+
+        scores = get_fuzzy_scores(utils.default_process(q))
+        candidates = np.flatnonzero(scores > 0.5)
+        candidate_scores = self.truncate(scores[candidates], decimals=1)
+
+        # Only the best `limit` scores (and anything tied with the last
+        # of them) can make it into the response, drop the rest before
+        # building suggestions and computing distances
+        if len(candidates) > limit:
+            kth_score = np.partition(candidate_scores, -limit)[-limit]
+            keep = candidate_scores >= kth_score
+            candidates, candidate_scores = candidates[keep], candidate_scores[keep]
+
+        rows = CITIES_DF.iloc[candidates]
+
+        suggestions = [{
+            "name": name.title() + ", " + suffix,
+            "latitude": latitude,
+            "longitude": longitude,
+            "score": score
+        } for name, suffix, latitude, longitude, score in zip(rows["ascii"].tolist(), rows["suffix"].tolist(),
+                                                              rows["lat"].tolist(), rows["long"].tolist(),
+                                                              candidate_scores.tolist())]
+
+        if "latitude" in args and "longitude" in args:
+            distances = haversine(float(args["latitude"]), float(args["longitude"]),
+                                  LATS_RAD[candidates], LONGS_RAD[candidates])
+            for suggestion, distance in zip(suggestions, distances.tolist()):
+                suggestion["distance"] = distance
+
+        if "latitude" in args and "longitude" in args:
+            suggestions = heapq.nlargest(limit, suggestions, key=lambda element: (element["score"], -element["distance"]))
         else:
-            return response
+            suggestions = heapq.nlargest(limit, suggestions, key=itemgetter('score'))
+
+        return Response(self.stream(suggestions), mimetype='application/json')
 
 
 # Restful resource endpoint
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import main
 import unittest
 
@@ -64,6 +65,54 @@ class TestApp(unittest.TestCase):
         self.assertEqual(r.status_code, 200)
         self.assertEqual(response, string)
 
+    def test_query_is_non_ascii_output(self):
+        main.app.testing = True
+        client = main.app.test_client()
+        r = client.get('/suggestions?q=Québec')
+        response = '{suggestions: []}'
+        string = r.data.decode("utf-8").strip()
+        string = string.replace('"', "")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(response, string)
+
+    def test_query_too_short_output(self):
+        main.app.testing = True
+        client = main.app.test_client()
+        r = client.get('/suggestions?q=a')
+        response = '{suggestions: []}'
+        string = r.data.decode("utf-8").strip()
+        string = string.replace('"', "")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(response, string)
+
+    def test_near_match(self):
+        main.app.testing = True
+        client = main.app.test_client()
+        r = client.get('/suggestions?q=Londo&latitude=43.70011&longitude=-79.4163')
+        suggestions = json.loads(r.data.decode("utf-8"))["suggestions"]
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual("application/json", r.mimetype)
+        self.assertEqual("London, ON, Canada", suggestions[0]["name"])
+        self.assertEqual(0.9, suggestions[0]["score"])
+        self.assertNotIn("distance", suggestions[0])
+
+    def test_limit(self):
+        main.app.testing = True
+        client = main.app.test_client()
+        r = client.get('/suggestions?q=Londo&limit=2')
+        suggestions = json.loads(r.data.decode("utf-8"))["suggestions"]
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(2, len(suggestions))
+
+    def test_invalid_limit(self):
+        main.app.testing = True
+        client = main.app.test_client()
+        r = client.get('/suggestions?q=Londo&limit=0')
+        string = r.data.decode("utf-8").strip()
+        string = string.replace('"', "")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual("value must be at least 1 for dictionary value @ data['limit']", string)
+
 
 if __name__ == '__main__':
     unittest.main()